@@ -6,14 +6,29 @@ from datetime import datetime, timedelta, timezone
 from neuralprophet import NeuralProphet, set_log_level
 import os
 import aiohttp
-import requests
 import asyncio
-import json
+import orjson
 import ssl
-import math
+import re
+import traceback
 import yaml
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """
+        Fallback when numba is not available, the function runs as plain Python.
+        """
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 TIMEOUT = 240
+MAX_CONCURRENT_FETCHES = 4
+RETRAIN_HOURS = 24
+RESTART_CHECK_MINUTES = 5
+DEBUG = False
 TIME_FORMAT_HA = "%Y-%m-%dT%H:%M:%S%z"
 TIME_FORMAT_HA_DOT = "%Y-%m-%dT%H:%M:%S.%f%z"
 
@@ -22,23 +37,83 @@ def timestr_to_datetime(timestamp):
     Convert a Home Assistant timestamp string to a datetime object.
     """
     try:
-        start_time = datetime.strptime(timestamp, TIME_FORMAT_HA)
+        start_time = datetime.fromisoformat(timestamp)
     except ValueError:
         try:
-            start_time = datetime.strptime(timestamp, TIME_FORMAT_HA_DOT)
+            start_time = datetime.strptime(timestamp, TIME_FORMAT_HA)
         except ValueError:
-            start_time = None
+            try:
+                start_time = datetime.strptime(timestamp, TIME_FORMAT_HA_DOT)
+            except ValueError:
+                start_time = None
+    # fromisoformat also accepts timestamps without a UTC offset, which HA never sends
+    if start_time and start_time.tzinfo is None:
+        start_time = None
     if start_time:
         start_time = start_time.replace(second=0, microsecond=0)
     return start_time
 
+@njit(cache=True)
+def accumulate_increments(values, timestamps, start, end, period, reset_low, reset_high, max_increment):
+    """
+    Total the increments of an incrementing sensor into periods.
+
+    The timestamps and start/end are in epoch minutes, returns the period timestamps and totals.
+    """
+    count = max((end - start) // period + 1, 0)
+    out_ts = np.empty(count, dtype=np.int64)
+    out_values = np.empty(count, dtype=np.float64)
+
+    timenow = start
+    data_index = 0
+    data_len = len(values)
+    total = 0.0
+    last_value = values[0] if data_len else 0.0
+    count = 0
+    while timenow <= end and data_index < data_len:
+        value = values[data_index]
+
+        # Reset?
+        if value < last_value and value < reset_low and last_value > reset_high:
+            total = total + value
+        else:
+            # Filter on max increment
+            if max_increment != 0 and abs(value - last_value) > max_increment:
+                value = last_value  # Avoid spikes
+
+            # Update total
+            total = max(total + value - last_value, 0.0)
+        last_value = value
+
+        if timestamps[data_index] < timenow:
+            data_index += 1
+            continue
+
+        out_ts[count] = timenow
+        out_values[count] = max(0.0, total)
+        count += 1
+        total = 0.0
+        timenow += period
+    return out_ts[:count], out_values[:count]
 
 class HAInterface():
     def __init__(self):
         self.ha_key = os.environ.get("SUPERVISOR_TOKEN")
         self.ha_url = "http://supervisor/core"
+        headers = {
+            "Authorization": "Bearer " + self.ha_key,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        self.session = aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=TIMEOUT), connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60))
         print("HA Interface started key {} url {}".format(self.ha_key, self.ha_url))
 
+    async def close(self):
+        """
+        Close the connection to Home Assistant.
+        """
+        await self.session.close()
+
     async def get_events(self):
         res = await self.api_call("/api/events")
         return res
@@ -48,18 +123,22 @@ class HAInterface():
         Get the history for a sensor from Home Assistant.
 
         :param sensor: The sensor to get the history for.
-        :return: The history for the sensor.
+        :return: The history states and last updated timestamps for the sensor, with the start and end times.
         """
         start = now - timedelta(days=days)
         end = now
         print("Getting history for sensor {} start {} end {}".format(sensor, start.strftime(TIME_FORMAT_HA), end.strftime(TIME_FORMAT_HA)))
         res = await self.api_call("/api/history/period/{}".format(start.strftime(TIME_FORMAT_HA)), {"filter_entity_id": sensor, "end_time": end.strftime(TIME_FORMAT_HA)})
-        if res:
+        states = np.empty(0, dtype=object)
+        timestamps = np.empty(0, dtype=object)
+        if res and res[0]:
             res = res[0]
-            start = timestr_to_datetime(res[0]["last_updated"])
-            end = timestr_to_datetime(res[-1]["last_updated"])
+            states = np.array([row["state"] for row in res], dtype=object)
+            timestamps = np.array([row["last_updated"] for row in res], dtype=object)
+            start = timestr_to_datetime(timestamps[0])
+            end = timestr_to_datetime(timestamps[-1])
         print("History for sensor {} starts at {} ends at {}".format(sensor, start, end))
-        return res, start, end
+        return states, timestamps, start, end
 
     async def get_state(self, entity_id=None, default=None, attribute=None):
         """
@@ -93,27 +172,17 @@ class HAInterface():
         :return: The response from the API.
         """
         url = self.ha_url + endpoint
-        headers = {
-            "Authorization": "Bearer " + self.ha_key,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
-        if post:
-            if datain:
-                response = await asyncio.to_thread(requests.post, url, headers=headers, json=datain, timeout=TIMEOUT)
-            else:
-                response = await asyncio.to_thread(requests.post, url, headers=headers, timeout=TIMEOUT)
-        else:
-            if datain:
-                response = await asyncio.to_thread(requests.get, url, headers=headers, params=datain, timeout=TIMEOUT)
-            else:
-                response = await asyncio.to_thread(requests.get, url, headers=headers, timeout=TIMEOUT)
         try:
-            data = response.json()
-        except requests.exceptions.JSONDecodeError:
+            if post:
+                async with self.session.post(url, json=datain) as response:
+                    data = orjson.loads(await response.read())
+            else:
+                async with self.session.get(url, params=datain) as response:
+                    data = orjson.loads(await response.read())
+        except orjson.JSONDecodeError:
             print("Failed to decode response from {}".format(url))
             data = None
-        except (requests.Timeout, requests.exceptions.ReadTimeout):
+        except asyncio.TimeoutError:
             print("Timeout from {}".format(url))
             data = None
         return data
@@ -122,132 +191,153 @@ class Prophet:
     def __init__(self, period=30):
         set_log_level("ERROR")
         self.period = period
+        self.models = {}
 
-    async def process_dataset(self, sensor_name, new_data, start_time, end_time, incrementing=False, max_increment=0, reset_low=0.0, reset_high=0.0):
+    async def process_dataset(self, sensor_name, states, timestamps, start_time, end_time, incrementing=False, max_increment=0, reset_low=0.0, reset_high=0.0):
         """
         Store the data in the dataset for training.
         """
-        dataset = pd.DataFrame(columns=["ds", "y"])
-        
         timenow = start_time
         timenow = timenow.replace(second=0, microsecond=0, minute=0)
-        data_index = 0
-        value = 0
-        data_len = len(new_data)
-        total = 0
-        last_value = None
 
         print("Process dataset for sensor {} start {} end {} incrementing {} reset_low {} reset_high {}".format(sensor_name, start_time, end_time, incrementing, reset_low, reset_high))
-        while timenow <= end_time and data_index < data_len:
-            try:
-                value = float(new_data[data_index]["state"])
-                if last_value is None:
-                    last_value = value
-            except ValueError:
-                if last_value is not None:
-                    value = last_value
-                else:
-                    data_index += 1
-                    continue
-
-            last_updated = new_data[data_index]["last_updated"]
-            start_time = timestr_to_datetime(last_updated)
-
-            if incrementing:
-                # Reset?
-                if value < last_value and value < reset_low and last_value > reset_high:
-                    total = total + value
-                else:
-                    # Filter on max increment
-                    if max_increment and abs(value - last_value) > max_increment:
-                        value = last_value  # Avoid spikes
-
-                    # Update total
-                    total = max(total + value - last_value, 0)
-            last_value = value
-        
-            if not start_time or start_time < timenow:
-                data_index += 1
-                continue
-
-            real_value = value
-            if incrementing:
-                real_value = max(0, total)
-                total = 0
-            dataset.loc[len(dataset)] = {"ds": timenow, "y": real_value}
-            timenow = timenow + timedelta(minutes=self.period)
-
-        print(dataset)
+        states = pd.to_numeric(pd.Series(states, dtype=object), errors="coerce").ffill()
+        stamps = pd.to_datetime(pd.Series(timestamps, dtype=object), utc=True, format="ISO8601", errors="coerce").dt.floor("min")
+
+        # Skip entries before the first numerical state and those without a valid timestamp
+        valid = (states.notna() & stamps.notna()).to_numpy()
+        values = states.to_numpy(dtype=np.float64)[valid]
+        times = stamps.dt.tz_localize(None).to_numpy()[valid].astype("datetime64[m]")
+        if not len(values):
+            return pd.DataFrame({"ds": pd.to_datetime([], utc=True), "y": np.empty(0, dtype=np.float32)}), 0
+
+        start = np.datetime64(timenow.astimezone(timezone.utc).replace(tzinfo=None), "m")
+        end = np.datetime64(end_time.astimezone(timezone.utc).replace(tzinfo=None), "m")
+
+        if incrementing:
+            # The totals carry from one entry to the next, so this is a compiled loop rather than vectorised
+            minutes, y = accumulate_increments(values, times.astype(np.int64), start.astype(np.int64), end.astype(np.int64), int(self.period), float(reset_low), float(reset_high), float(max_increment))
+            periods = minutes.astype("datetime64[m]")
+        else:
+            # Each period takes the first entry at or after its timestamp
+            periods = np.arange(start, end + np.timedelta64(1, "m"), np.timedelta64(self.period, "m"))
+            index = np.searchsorted(times, periods, side="left")
+            keep = index < len(values)
+            periods = periods[keep]
+            y = values[index[keep]]
+
+        # Sensor values only need float32, which halves the memory of every later step
+        dataset = pd.DataFrame({"ds": pd.to_datetime(periods, utc=True), "y": y.astype(np.float32)})
+        value = values[-1]
+
+        if DEBUG:
+            print(dataset)
         # dataset.to_csv('/config/{}.csv'.format(sensor_name), index=False) 
 
         return dataset, value
     
-    async def train(self, dataset, future_periods, n_lags=0, country=None, covariates_data=None):
-        self.model = NeuralProphet(n_lags=n_lags, yearly_seasonality=True, weekly_seasonality=True, daily_seasonality=True)
-    
-        # Add country holidays if specified
-        if country:
-            self.model.add_country_holidays(country)
-        
-        # Add covariates (regressors)
+    async def train(self, dataset, future_periods, n_lags=0, country=None, covariates_data=None, sensor_name=None):
+        """
+        Train the model and predict, in a worker thread so the event loop and other sensors can carry on.
+        """
+        await asyncio.to_thread(self.fit_predict, dataset, future_periods, n_lags=n_lags, country=country, covariates_data=covariates_data, sensor_name=sensor_name)
+
+    def fit_predict(self, dataset, future_periods, n_lags=0, country=None, covariates_data=None, sensor_name=None):
+        """
+        Train the model on the dataset and store the forecast, blocks while training.
+        """
+        covariate_names = tuple(covariates_data.keys()) if covariates_data else ()
+        key = (sensor_name, n_lags, country, covariate_names)
+
+        # Reuse the model from the last cycle for prediction until it is due to be trained again
+        cached = self.models.get(key)
+        if cached and dataset["ds"].max() - cached["fitted_ds"] >= timedelta(hours=RETRAIN_HOURS):
+            cached = None
+
+        if cached:
+            self.model = cached["model"]
+        else:
+            self.model = NeuralProphet(n_lags=n_lags, yearly_seasonality=True, weekly_seasonality=True, daily_seasonality=True)
+
+            # Add country holidays if specified
+            if country:
+                self.model.add_country_holidays(country)
+
+            # Add covariates (regressors)
+            for covariate_name in covariate_names:
+                self.model = self.model.add_future_regressor(covariate_name)
+
+        # Add the covariates as columns named after them, in one join
         if covariates_data:
-            for covariate_name, covariate_dataset in covariates_data.items():
-                self.model = self.model.add_regressor(covariate_name)
-                dataset = dataset.merge(covariate_dataset, on='ds', how='left')
-        
-        # Train the model
-        self.metrics = self.model.fit(dataset, freq=(str(self.period) + "min"), progress=None)
-        
+            covariates = [covariate_dataset.set_index("ds")[["y"]].rename(columns={"y": covariate_name}) for covariate_name, covariate_dataset in covariates_data.items()]
+            dataset = dataset.set_index("ds").join(covariates, how="left").reset_index()
+            # Regressors can't have gaps, fill them from the nearest value
+            dataset[list(covariate_names)] = dataset[list(covariate_names)].ffill().bfill()
+
+        # NeuralProphet trains in float64
+        dataset = dataset.astype({column: np.float64 for column in dataset.columns if column != "ds"})
+
+        # Train the model, a fitted NeuralProphet can't be fitted again so a retrain uses a new one
+        if not cached:
+            self.metrics = self.model.fit(dataset, freq=(str(self.period) + "min"), progress=None)
+            self.models[key] = {"model": self.model, "fitted_ds": dataset["ds"].max()}
+        else:
+            print("Reusing model for sensor {} trained up to {}".format(sensor_name, cached["fitted_ds"]))
+
         # Create future dataframe for prediction
-        self.df_future = self.model.make_future_dataframe(dataset, n_historic_predictions=True, periods=future_periods)
+        regressors = self.future_covariates(dataset, covariate_names, future_periods) if covariate_names else None
+        self.df_future = self.model.make_future_dataframe(dataset, regressors_df=regressors, n_historic_predictions=True, periods=future_periods)
         self.forecast = self.model.predict(self.df_future)
-        print(self.forecast)
+        if DEBUG:
+            print(self.forecast)
  
+    def future_covariates(self, dataset, covariate_names, future_periods):
+        """
+        Future values of the covariates for the prediction periods.
+
+        The future of a covariate isn't known, so each period repeats the value from the same time of day
+        in the last day of history.
+        """
+        last_ds = dataset["ds"].max()
+        future = last_ds + pd.to_timedelta(np.arange(1, future_periods + 1) * self.period, unit="min")
+        days_ahead = np.ceil((future - last_ds) / pd.Timedelta(days=1))
+        past = future - pd.to_timedelta(days_ahead, unit="D")
+        history = dataset.set_index("ds")[list(covariate_names)].sort_index()
+        return history.reindex(past, method="ffill").bfill().reset_index(drop=True)
+
     async def save_prediction(self, entity, now, interface, start, incrementing=False, reset_daily=False, units="", days=7):
         """
         Save the prediction to Home Assistant.
         """
         pred = self.forecast
-        total = 0
-        total_org = 0
-        timeseries = {}
-        timeseries_org = {}
-
-        for index, row in pred.iterrows():
-            ptimestamp = row["ds"].tz_localize(timezone.utc)
-            diff = ptimestamp - now
-            timestamp = now + diff
-                
-            time = timestamp.strftime(TIME_FORMAT_HA)
-            value = row["yhat1"]
-            value_org = row["y"]
-
-            # Daily reset?
-            if timestamp <= now:
-                if reset_daily and timestamp.hour == 0 and timestamp.minute == 0:
-                    total = 0
-                    total_org = 0
-
-            total += value
-            if not math.isnan(value_org):
-                total_org += value_org
-            else:
-                value_org = None
-
-            # Avoid too much history in HA
-            if diff.days < -days:
-                continue
-       
-            if incrementing:
-                timeseries[time] = round(total, 2)
-                if value_org:
-                    timeseries_org[time] = round(total_org, 2)
-            else:
-                timeseries[time] = round(value, 2)
-                if value_org:
-                    timeseries_org[time] = round(value_org, 2)
+        timestamps = pred["ds"].dt.tz_localize(timezone.utc).dt.tz_convert(now.tzinfo)
+        values = pred["yhat1"]
+        values_org = pred["y"]
+
+        # Daily reset? Only applied to the history
+        reset = (timestamps <= now) & (timestamps.dt.hour == 0) & (timestamps.dt.minute == 0) & reset_daily
+        day = reset.cumsum()
+        total = values.groupby(day).cumsum()
+        total_org = values_org.fillna(0).groupby(day).cumsum()
+
+        # Avoid too much history in HA
+        keep = (timestamps - now).dt.days >= -days
+        keep_org = keep & values_org.notna() & (values_org != 0)
+        # Format as TIME_FORMAT_HA, now has a fixed UTC offset so it is the same for every row
+        times = np.datetime_as_string(timestamps.dt.tz_localize(None).to_numpy().astype("datetime64[s]"), unit="s")
+        times = np.char.add(times, now.strftime("%z"))
+        keep = keep.to_numpy()
+        keep_org = keep_org.to_numpy()
+
+        if incrementing:
+            timeseries = dict(zip(times[keep].tolist(), total[keep].round(2).tolist()))
+            timeseries_org = dict(zip(times[keep_org].tolist(), total_org[keep_org].round(2).tolist()))
+            final = total.iloc[-1]
+        else:
+            timeseries = dict(zip(times[keep].tolist(), values[keep].round(2).tolist()))
+            timeseries_org = dict(zip(times[keep_org].tolist(), values_org[keep_org].round(2).tolist()))
+            final = values.iloc[-1]
 
-        final = total if incrementing else value
         attributes = {"last_updated": str(now), "unit_of_measurement": units, "state_class" : "measurement", "results" : timeseries, "source" : timeseries_org}
         print("Saving prediction to {} last_update {}".format(entity, str(now)))
         await interface.set_state(entity, state=round(final,2), attributes=attributes)
@@ -256,35 +346,47 @@ async def subtract_set(dataset, subset, now, incrementing=False):
     """
     Subtract the subset from the dataset.
     """
-    pruned = pd.DataFrame(columns=["ds", "y"])
-    count = 0
-    for index, row in dataset.iterrows():
-        ds = row["ds"]
-        value = row["y"]
-        car_value = 0
-
-        car_row = subset.loc[subset["ds"] == ds]
-        if not car_row.empty:
-            car_value = car_row["y"].values[0]
-            count += 1
-
-        if incrementing:
-            value = max(value - car_value, 0)
-        else:
-            value = value - car_value
-        pruned.loc[len(pruned)] = {"ds": ds, "y": value}
-    print("Subtracted {} values into new set: {}".format(count, pruned))
+    pruned = dataset.merge(subset.drop_duplicates(subset="ds"), on="ds", how="left", suffixes=("", "_sub"))
+    sub_values = pruned.pop("y_sub")
+    count = sub_values.notna().sum()
+    sub_values = sub_values.fillna(0.0)
+
+    if incrementing:
+        pruned["y"] = np.maximum(pruned["y"] - sub_values, 0)
+    else:
+        pruned["y"] = pruned["y"] - sub_values
+    print("Subtracted {} values into new set".format(count))
+    if DEBUG:
+        print(pruned)
     return pruned
 
 class Database():
     def __init__(self):
         self.con = sqlite3.connect('/config/predai.db')
         self.cur = self.con.cursor()
+        self.cur.execute("PRAGMA journal_mode=WAL")
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+        self.cur.execute("PRAGMA temp_store=MEMORY")
+        self.cur.execute("PRAGMA cache_size=-20000")
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.con.close()
+
+    def check_table(self, table):
+        """
+        Check the table name is safe to use in an SQL statement.
+        """
+        if not re.fullmatch(r"[A-Za-z0-9_]+", table):
+            raise ValueError(f"Invalid database table name {table}")
 
     async def create_table(self, table):
         """
         Create a table in the database by table name if it does not exist.
         """
+        self.check_table(table)
         print(f"Create table {table}")
         self.cur.execute(f"CREATE TABLE IF NOT EXISTS {table} (timestamp TEXT PRIMARY KEY, value REAL)")
         self.con.commit()
@@ -294,16 +396,8 @@ class Database():
         Get the history from the database, sorted by timestamp.
         Returns a DataFrame with the history data.
         """
-        self.cur.execute(f"SELECT * FROM {table} ORDER BY timestamp")
-        rows = self.cur.fetchall()
-        history = pd.DataFrame(columns=["ds", "y"])
-        if not rows:
-            return history
-        for row in rows:
-            timestamp = row[0]
-            value = row[1]
-            history.loc[len(history)] = {"ds": timestamp, "y": value}
-        return history
+        self.check_table(table)
+        return pd.read_sql_query(f'SELECT timestamp AS ds, value AS y FROM "{table}" ORDER BY timestamp', self.con, parse_dates={"ds": {"utc": True}}, dtype={"y": np.float32})
 
     async def store_history(self, table, history, prev=None):
         """
@@ -311,20 +405,22 @@ class Database():
         Only the data associated with TIMESTAMPs not already in the database will be stored.
         Returns the updated history DataFrame.
         """
-        added_rows = 0
-        prev_values = prev["ds"].values if prev is not None else []
-        prev_values = prev_values.tolist()
-
-        for index, row in history.iterrows():
-            timestamp = str(row["ds"])
-            value = row["y"]
-            if timestamp not in prev_values:
-                if prev is not None:
-                    prev.loc[len(prev)] = {"ds": timestamp, "y": value}
-                self.cur.execute(f"INSERT INTO {table} (timestamp, value) VALUES ('{timestamp}', {value})")
-                added_rows += 1
-        self.con.commit()
-        print(f"Added {added_rows} rows to database table {table}")
+        self.check_table(table)
+        timestamps = history["ds"].astype(str)
+        if prev is not None:
+            new = ~timestamps.isin(prev["ds"].astype(str))
+        else:
+            new = pd.Series(True, index=history.index)
+        # Go via the shortest string form so float32 values are stored without rounding noise
+        rows = list(zip(timestamps[new], history["y"][new].astype(str).astype(float)))
+
+        # Single transaction for the whole batch
+        with self.con:
+            self.cur.executemany(f'INSERT OR IGNORE INTO "{table}" (timestamp, value) VALUES (?, ?)', rows)
+        if prev is not None and rows:
+            # New rows can be older than the stored ones, e.g. after days is raised
+            prev = pd.concat([prev, history[new]]).sort_values("ds", ignore_index=True)
+        print(f"Added {len(rows)} rows to database table {table}")
         return prev
 
 async def print_dataset(name, dataset):
@@ -337,7 +433,7 @@ async def print_dataset(name, dataset):
         if count > 24:
             break
 
-async def get_history(interface, nw, sensor, now, use_db):
+async def get_history(interface, nw, sensor, now, use_db, db):
     sensor_name = sensor['name']
     incrementing = sensor.get('incrementing', False)
     max_increment = sensor.get('max_increment', 0)
@@ -346,13 +442,12 @@ async def get_history(interface, nw, sensor, now, use_db):
     reset_high = sensor.get('reset_high', 0.0)
 
     # Fetch primary sensor data
-    dataset, start, end = await interface.get_history(sensor_name, now, days=days)
-    dataset, last_dataset_value = await nw.process_dataset(sensor_name, dataset, start, end, incrementing=incrementing, max_increment=max_increment, reset_low=reset_low, reset_high=reset_high)
+    states, timestamps, start, end = await interface.get_history(sensor_name, now, days=days)
+    dataset, last_dataset_value = await nw.process_dataset(sensor_name, states, timestamps, start, end, incrementing=incrementing, max_increment=max_increment, reset_low=reset_low, reset_high=reset_high)
 
     # Store history in the database if required
     if use_db:
         table_name = sensor_name.replace(".", "_")
-        db = Database()
         await db.create_table(table_name)
         prev = await db.get_history(table_name)
         dataset = await db.store_history(table_name, dataset, prev)
@@ -367,84 +462,136 @@ async def get_history(interface, nw, sensor, now, use_db):
             cov_days = covariate.get('days', days)
             
             # Fetch and process covariate data
-            covariate_dataset, cov_start, cov_end = await interface.get_history(covariate_name, now, days=cov_days)
-            covariate_dataset, _ = await nw.process_dataset(covariate_name, covariate_dataset, cov_start, cov_end, incrementing=cov_incrementing)
+            cov_states, cov_timestamps, cov_start, cov_end = await interface.get_history(covariate_name, now, days=cov_days)
+            covariate_dataset, _ = await nw.process_dataset(covariate_name, cov_states, cov_timestamps, cov_start, cov_end, incrementing=cov_incrementing)
             covariates_data[covariate_name] = covariate_dataset
 
     return dataset, start, end, covariates_data
     
+async def process_sensor(sensor, interface, now, predictors, db, fetch_semaphore, train_lock):
+    """
+    Fetch the history, train the model and save the prediction for a sensor.
+
+    Fetches are capped by fetch_semaphore to limit the load on HA, and training holds train_lock
+    so only one model trains at a time while other sensors carry on with their I/O.
+    """
+    sensor_name = sensor.get("name", None)
+    subtract_names = sensor.get("subtract", None)
+    days = sensor.get("days", 7)
+    export_days = sensor.get("export_days", days)
+    incrementing = sensor.get("incrementing", False)
+    reset_daily = sensor.get("reset_daily", False)
+    interval = sensor.get("interval", 30)
+    units = sensor.get("units", "")
+    future_periods = sensor.get("future_periods", 96)
+    use_db = sensor.get("database", True)
+    reset_low = sensor.get("reset_low", 1.0)
+    reset_high = sensor.get("reset_high", 2.0)
+    max_increment = sensor.get("max_increment", 0)
+    n_lags = sensor.get("n_lags", 0)
+    country = sensor.get("country", None)
+
+    if not sensor_name:
+        return
+
+    # Keep the predictor between updates so its trained models can be reused
+    nw = predictors.get(sensor_name, None)
+    if not nw or nw.period != interval:
+        nw = Prophet(interval)
+        predictors[sensor_name] = nw
+
+    print(f"Update at time {now}, processing sensor {sensor_name}, incrementing {incrementing}")
+
+    async with fetch_semaphore:
+        # Get sensor data and covariates
+        dataset, start, end, covariates_data = await get_history(interface, nw, sensor, now, use_db, db=db)
+
+        # Get and process subtract data (if any)
+        subtract_data_list = []
+        if subtract_names:
+            if isinstance(subtract_names, str):
+                subtract_names = [subtract_names]
+            for subtract_name in subtract_names:
+                subtract_sensor = {"name": subtract_name, "incrementing": incrementing, "max_increment": max_increment, "days": days, "reset_low": reset_low, "reset_high": reset_high}
+                subtract_data, sub_start, sub_end, _ = await get_history(interface, nw, subtract_sensor, now, use_db, db=db)
+                subtract_data_list.append(subtract_data)
+
+    if subtract_data_list:
+        print("Subtracting data")
+        for subtract_data in subtract_data_list:
+            dataset = await subtract_set(dataset, subtract_data, now, incrementing=incrementing)
+
+    # Train the model with dataset and covariates
+    async with train_lock:
+        await nw.train(dataset, future_periods, n_lags=n_lags, country=country, covariates_data=covariates_data, sensor_name=sensor_name)
+
+    # Save the prediction
+    await nw.save_prediction(sensor_name + "_prediction", now, interface, start=end, incrementing=incrementing, reset_daily=reset_daily, units=units, days=export_days)
+
+async def watch_last_run(interface, restart):
+    """
+    Set the restart event if the last run sensor is removed from Home Assistant.
+    """
+    while True:
+        await asyncio.sleep(RESTART_CHECK_MINUTES * 60)
+        try:
+            last_run = await interface.get_state("sensor.predai_last_run")
+        except aiohttp.ClientError as e:
+            print("WARN: Failed to check sensor.predai_last_run: {}".format(e))
+            continue
+        if last_run is None:
+            print("Restarting PredAI as last-run time has gone")
+            restart.set()
+            return
+
 async def main():
     """
     Main function for the prediction AI.
     """
+    global DEBUG
     interface = HAInterface()
-    # Main function loop
-    while True:
-        config = yaml.safe_load(open("/config/predai.yaml"))
-        if not config:
-            print("WARN: predai.yaml is missing, no work to do")
-        else:
-            print("Configuration loaded")
-            update_every = config.get('update_every', 30)
-            sensors = config.get("sensors", [])
-            for sensor in sensors:
-                sensor_name = sensor.get("name", None)
-                subtract_names = sensor.get("subtract", None)
-                days = sensor.get("days", 7)
-                export_days = sensor.get("export_days", days)
-                incrementing = sensor.get("incrementing", False)
-                reset_daily = sensor.get("reset_daily", False)
-                interval = sensor.get("interval", 30)
-                units = sensor.get("units", "")
-                future_periods = sensor.get("future_periods", 96)
-                use_db = sensor.get("database", True)
-                reset_low = sensor.get("reset_low", 1.0)
-                reset_high = sensor.get("reset_high", 2.0)
-                max_increment = sensor.get("max_increment", 0)
-                n_lags = sensor.get("n_lags", 0)
-                country = sensor.get("country", None)
-    
-                if not sensor_name:
-                    continue
-    
-                nw = Prophet(interval)
+    db = Database()
+    predictors = {}
+    fetch_semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    train_lock = asyncio.Lock()
+    try:
+        # Main function loop
+        while True:
+            config = yaml.safe_load(open("/config/predai.yaml"))
+            if not config:
+                print("WARN: predai.yaml is missing, no work to do")
+            else:
+                print("Configuration loaded")
+                update_every = config.get('update_every', 30)
+                DEBUG = config.get('debug', False)
+                sensors = config.get("sensors", [])
                 now = datetime.now(timezone.utc).astimezone()
                 now = now.replace(second=0, microsecond=0, minute=0)
-    
-                print(f"Update at time {now}, processing sensor {sensor_name}, incrementing {incrementing}")
-    
-                # Get sensor data and covariates
-                dataset, start, end, covariates_data = await get_history(interface, nw, sensor, now, use_db)
-    
-                # Get and process subtract data (if any)
-                subtract_data_list = []
-                if subtract_names:
-                    if isinstance(subtract_names, str):
-                        subtract_names = [subtract_names]
-                    for subtract_name in subtract_names:
-                        subtract_data, sub_start, sub_end = await get_history(interface, nw, subtract_name, now, incrementing, max_increment, days, use_db, reset_low, reset_high)
-                        subtract_data_list.append(subtract_data)
-    
-                if subtract_data_list:
-                    print("Subtracting data")
-                    for subtract_data in subtract_data_list:
-                        dataset = await subtract_set(dataset, subtract_data, now, incrementing=incrementing)
-    
-                # Train the model with dataset and covariates
-                await nw.train(dataset, future_periods, n_lags=n_lags, country=country, covariates_data=covariates_data)
-    
-                # Save the prediction
-                await nw.save_prediction(sensor_name + "_prediction", now, interface, start=end, incrementing=incrementing, reset_daily=reset_daily, units=units, days=export_days)
 
-
-        time_now = datetime.now(timezone.utc).astimezone()
-        await interface.set_state("sensor.predai_last_run", state=str(time_now), attributes={"unit_of_measurement": "time"})
-        print("Waiting for {} minutes at time {}".format(update_every, datetime.now(timezone.utc).astimezone()))
-        for n in range(update_every):
-            last_run = await interface.get_state("sensor.predai_last_run")
-            if last_run is None:
-                print("Restarting PredAI as last-run time has gone")
-                break
-            await asyncio.sleep(60)
+                # Sensors are independent, so process them concurrently
+                results = await asyncio.gather(*(process_sensor(sensor, interface, now, predictors, db, fetch_semaphore, train_lock) for sensor in sensors), return_exceptions=True)
+                for sensor, result in zip(sensors, results):
+                    if isinstance(result, Exception):
+                        print("ERROR: Failed to process sensor {}: {}: {}".format(sensor.get("name", None), type(result).__name__, result))
+                        traceback.print_exception(result)
+
+            time_now = datetime.now(timezone.utc).astimezone()
+            await interface.set_state("sensor.predai_last_run", state=str(time_now), attributes={"unit_of_measurement": "time"})
+            print("Waiting for {} minutes at time {}".format(update_every, datetime.now(timezone.utc).astimezone()))
+            restart = asyncio.Event()
+            watcher = asyncio.create_task(watch_last_run(interface, restart))
+            try:
+                await asyncio.wait_for(restart.wait(), timeout=update_every * 60)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                watcher.cancel()
+                result = (await asyncio.gather(watcher, return_exceptions=True))[0]
+                if isinstance(result, Exception):
+                    print("ERROR: Restart watcher failed: {}: {}".format(type(result).__name__, result))
+                    traceback.print_exception(result)
+    finally:
+        await interface.close()
+        db.close()
 
 asyncio.run(main())